@@ -1,24 +1,30 @@
 import numpy as np
+import pandas as pd
+import csv
 from pathlib import Path
-from scipy.spatial.distance import cdist
-import os, codecs, re
+import os, codecs
 from utils import hparams as hp
 import argparse
+from multiprocessing import Pool, cpu_count
+
+def read_label(labfile, comment=None):
+    '''Read (start, end, label) columns from an HTK-style label file with the C csv parser'''
+    labels = pd.read_csv(labfile, sep=r'\s+', header=None, usecols=[0, 1, 2], comment=comment,
+                         quoting=csv.QUOTE_NONE, dtype={0: np.int64, 1: np.int64, 2: str},
+                         keep_default_na=False, na_filter=False, engine='c')
+    return labels[0].to_numpy(), labels[1].to_numpy(), labels[2].to_numpy()
 
 def plain_phone_label_to_monophones(labfile):
-    labels = np.loadtxt(labfile, dtype=str, comments='#') ## default comments='#' breaks
-    starts = labels[:,0].astype(int)
-    ends = labels[:,1].astype(int)
-    mono = labels[:,2]
+    starts, ends, mono = read_label(labfile, comment='#')
     lengths = (ends - starts) / 10000 ## length in msec
     return (mono, lengths)
 
 def merlin_state_label_to_monophones(labfile):
-    labels = np.loadtxt(labfile, dtype=str, comments=None) ## default comments='#' breaks
-    starts = labels[:,0].astype(int)[::5]
-    ends = labels[:,1].astype(int)[4::5]
-    fc = labels[:,2][::5]
-    mono = [label.split('-')[1].split('+')[0] for label in fc]
+    starts, ends, fc = read_label(labfile) ## comment='#' breaks full-context labels
+    starts = starts[::5]
+    ends = ends[4::5]
+    fc = fc[::5]
+    mono = pd.Series(fc).str.extract(r'^[^-]*-([^-+]*)', expand=False).to_numpy() ## p1^p2-MONO+p4=p5...
     # return zip(starts, ends, mono)
 
     lengths = (ends - starts) / 10000 ## length in msec
@@ -38,16 +44,21 @@ def resample_timings(lengths, from_rate, to_rate, total_duration):
         return None
 
 
-    ## find closest valid end given new sample rate
-    ends = np.cumsum(lengths)
-    new_valid_positions = np.arange(0,ends[-1] + (from_rate*3),float(to_rate))
-    distances = cdist(np.expand_dims(ends,-1), np.expand_dims(new_valid_positions, -1))
-    in_new_rate = new_valid_positions[distances.argmin(axis=1)]
-    if 0:
-        print(zip(ends, in_new_rate))
+    if to_rate == from_rate:
+        ## every end point is already on the new grid
+        in_new_rate = np.array(lengths, dtype=float)
+    else:
+        ## find closest valid end given new sample rate: the valid positions are a
+        ## uniform grid, so round onto it (ties go to the earlier position) and clip
+        ## to the last position before ends[-1] + from_rate*3
+        ends = np.cumsum(lengths)
+        last_valid_position = (np.ceil((ends[-1] + from_rate*3) / to_rate) - 1) * to_rate
+        in_new_rate = np.minimum(np.ceil(ends / to_rate - 0.5) * to_rate, last_valid_position)
+        if 0:
+            print(zip(ends, in_new_rate))
 
-    ## undo cumsum to get back from end points to durations:
-    in_new_rate[1:] -= in_new_rate[:-1].copy()
+        ## undo cumsum to get back from end points to durations:
+        in_new_rate = np.diff(in_new_rate, prepend=0)
 
     if total_duration:
         diff = total_duration - in_new_rate.sum()
@@ -88,7 +99,7 @@ def match_up(merlin_label_timings, phoneme_label):
 
 def write_transcript(texts, transcript_file, duration=False):
 
-    f = codecs.open(transcript_file, 'w', 'utf-8')
+    lines = []
 
     for base in sorted(texts.keys()):
         phones = ' '.join(texts[base]['phones'])
@@ -97,56 +108,95 @@ def write_transcript(texts, transcript_file, duration=False):
             if 'duration' not in texts[base]:
                 print('Warning: skip %s because no duration'%(base))
                 continue
-            dur = ' '.join(np.array(texts[base]['duration'], dtype='str'))
+            dur = ' '.join(map(str, texts[base]['duration']))
             line += '||%s'%(dur)  ## leave empty speaker ID field
-        f.write(line + '\n')
-    f.close()
+        lines.append(line + '\n')
+
+    with codecs.open(transcript_file, 'w', 'utf-8') as f:
+        f.writelines(lines)
     print('Wrote to %s' %(transcript_file))
 
 def read_transcript(transcript_file):
-    texts = codecs.open(transcript_file, 'r', 'utf-8', errors='ignore').readlines()
-    texts = [line.strip('\n\r |') for line in texts]
-    texts = [t for t in texts if t != '']
-    texts = [line.strip().split("|") for line in texts]
-
-    for line in texts:
-        assert len(line) == len(texts[0]), line
-
     transcript = {}
+    nfields = None
 
-    for text in texts:
-        assert len(text) >= 4  ## assume phones
-        base, plaintext, normtext, phones = text[:4]
-        phones = re.split('\s+', phones)
-        transcript[base] = {'phones': phones, 'text': normtext}
+    with codecs.open(transcript_file, 'r', 'utf-8', errors='ignore') as f:
+        for line in f:
+            line = line.strip('\n\r |').strip()
+            if line == '':
+                continue
+            text = line.split('|')
+            if nfields is None:
+                nfields = len(text)
+            assert len(text) == nfields, text
+            assert len(text) >= 4  ## assume phones
+            base, plaintext, normtext, phones = text[:4]
+            transcript[base] = {'phones': phones.split(), 'text': normtext}
 
     return transcript
 
-def durations_to_attention_matrix(durations):
+def save_guided_attention(durations, outfile):
     '''
-    Take array of durations, return selection matrix to replace A in attention mechanism.
-    E.g.:
-    durations_to_hard_attention_matrix(np.array([3,0,1,2]))
-    [[1. 1. 1. 0. 0. 0.]
-     [0. 0. 0. 0. 0. 0.]
-     [0. 0. 0. 1. 0. 0.]
-     [0. 0. 0. 0. 1. 1.]]
+    The hard attention guide has one nonzero per frame and is fully determined by
+    the per-phone durations, so store those (int32, O(nphones)) and rebuild the
+    matrix on load with utils.files.durations_to_attention_matrix.
     '''
-    nphones = len(durations)
-    nframes = durations.sum()
-    A = np.zeros((nframes, nphones), dtype=np.float32)
-    start = 0
-    for (i,dur) in enumerate(durations):
-        end = start + dur
-        A[start:end,i] = 1.0
-        start = end
-    assert A.sum(axis=1).all() == 1.0
-    assert A.sum(axis=0).all() == durations.all()
-    return A
-
-def save_guided_attention(matrix, outfile):
-    np.save(outfile, matrix, allow_pickle=False)
-    print('Created attention guide %s' %(outfile))§
+    np.save(outfile, np.asarray(durations, dtype=np.int32), allow_pickle=False)
+    print('Created attention guide %s' %(outfile))
+
+def init_worker(data_path, model_name, phones):
+    '''Share settings and transcript phones with each worker once, not per task'''
+    global _data_path, _model, _phones
+    _data_path = data_path
+    _model = model_name
+    _phones = phones
+
+def process_labfile(labfile):
+   model = _model
+
+   if model == "dctts":
+       time_step = 50
+   else:
+       time_step = 12.5
+
+   print(f'Processing {labfile} ... ')
+   labfile = Path(labfile)
+   #out_guide_file = Path(f'{_data_path}/attention_guides_dctts/{labfile.stem}.npy')
+   out_guide_file = Path(f'{_data_path}/attention_guides/{labfile.stem}.npy')
+
+   labfile = Path(os.path.join(f'{_data_path}/labels/label_state_align/',labfile))
+   (mono, lengths) =   merlin_state_label_to_monophones(labfile)
+
+
+   mel_file = labfile.stem
+
+
+   # NOTE THE DIMENSIONS -- dctts nframe is in [0] and taco is in [1]
+   mel_features = np.load(f'{_data_path}/mel/{mel_file}.npy')
+   if model == "dctts":
+       audio_msec_length = mel_features.shape[0] * time_step
+   else:
+       audio_msec_length = mel_features.shape[1] * time_step
+
+   resampled_lengths = resample_timings(lengths, 5.0, time_step, total_duration=audio_msec_length)
+
+
+
+   if resampled_lengths is not None:
+       resampled_lengths_in_frames = (resampled_lengths / time_step).astype(int)
+
+       phones = _phones[labfile.stem]
+       timings = match_up((mono, resampled_lengths_in_frames), phones)
+
+
+       assert len(phones) == len(timings), (len(phones), len(timings), phones, timings)
+
+       save_guided_attention(timings, out_guide_file)
+
+       return labfile.stem, timings
+
+   print(f'{labfile} was not successfully processed!')
+   return labfile.stem, None
 
 def main_work():
 
@@ -161,11 +211,6 @@ def main_work():
    hp.configure(args.hp_file)  # Load hparams from file
    model = args.model_name
 
-   if model == "dctts":
-       time_step = 50
-   else:
-       time_step = 12.5
-
 
    transcript_file = Path(f'{hp.data_path}/{hp.metadata}')
    outfile = Path(f'{hp.data_path}/train_durations.csv')
@@ -185,48 +230,16 @@ def main_work():
         print(f'{hp.data_path}/mel is empty')
         exit()
 
-   for labfile in os.listdir(f'{hp.data_path}/labels/label_state_align/'):
-       print(f'Processing {labfile} ... ')
-       labfile = Path(labfile)
-       #os.makedirs(f'{hp.data_path}/attention_guides_dctts', exist_ok=True)
-       #out_guide_file = Path(f'{hp.data_path}/attention_guides_dctts/{labfile.stem}.npy')
-       os.makedirs(f'{hp.data_path}/attention_guides', exist_ok=True)
-       out_guide_file = Path(f'{hp.data_path}/attention_guides/{labfile.stem}.npy')
-
-       labfile = Path(os.path.join(f'{hp.data_path}/labels/label_state_align/',labfile))
-       (mono, lengths) =   merlin_state_label_to_monophones(labfile)
-
-
-       mel_file = labfile.stem
-      
-
-       # NOTE THE DIMENSIONS -- dctts nframe is in [0] and taco is in [1]
-       mel_features = np.load(f'{hp.data_path}/mel/{mel_file}.npy')
-       if model == "dctts":
-           audio_msec_length = mel_features.shape[0] * time_step
-       else:
-           audio_msec_length = mel_features.shape[1] * time_step
-
-       resampled_lengths = resample_timings(lengths, 5.0, time_step, total_duration=audio_msec_length)
-
-
-
-       if resampled_lengths is not None:
-           resampled_lengths_in_frames = (resampled_lengths / time_step).astype(int)
-
-
-           timings = match_up((mono, resampled_lengths_in_frames), transcript[labfile.stem]['phones'])
-
-
-           assert len(transcript[labfile.stem]['phones']) == len(timings), (len(transcript[labfile.stem]['phones']), len(timings), transcript[labfile.stem]['phones'], timings)
-           transcript[labfile.stem]['duration'] = timings
-
-           guided_attention_matrix = durations_to_attention_matrix(np.array(timings))
+   #os.makedirs(f'{hp.data_path}/attention_guides_dctts', exist_ok=True)
+   os.makedirs(f'{hp.data_path}/attention_guides', exist_ok=True)
 
-           save_guided_attention(guided_attention_matrix, out_guide_file)
+   labfiles = os.listdir(f'{hp.data_path}/labels/label_state_align/')
+   phones = {base: transcript[base]['phones'] for base in transcript}
 
-       else:
-           print(f'{labfile} was not successfully processed!')
+   with Pool(cpu_count(), initializer=init_worker, initargs=(hp.data_path, model, phones)) as pool:
+       for base, timings in pool.imap_unordered(process_labfile, labfiles):
+           if timings is not None:
+               transcript[base]['duration'] = timings
 
    write_transcript(transcript, outfile, duration=True)
 
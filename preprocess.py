@@ -2,7 +2,8 @@ import glob
 from utils.display import *
 from utils.dsp import *
 from utils import hparams as hp
-from multiprocessing import Pool, cpu_count
+from multiprocessing import cpu_count
+from concurrent.futures import ProcessPoolExecutor
 from utils.paths import Paths
 import pickle
 import argparse
@@ -11,24 +12,9 @@ from utils.files import get_files
 from pathlib import Path
 
 
-parser = argparse.ArgumentParser(description='Preprocessing for WaveRNN and Tacotron')
-parser.add_argument('--path', '-p', help='directly point to location of CSV file')
-parser.add_argument('--extension', '-e', metavar='EXT', default='.wav', help='file extension to search for in dataset folder')
-parser.add_argument('--hp_file', metavar='FILE', default='hparams.py', help='The file to use for the hyperparameters')
-args = parser.parse_args()
-
-print(args.hp_file)
-hp.configure(args.hp_file)  # Load hparams from file
-if args.path is None:
-    args.path = hp.wav_path
-
-extension = args.extension
-path = args.path
-
-def convert_file(path: Path):
+def convert_file(path: str):
     path = path+".wav"
-    y = load_wav(path)
-    peak = np.abs(y).max()
+    y, peak = load_wav(path, return_peak=True)
     if hp.peak_norm or peak > 1.0:
         y /= peak
     mel = melspectrogram(y)
@@ -40,54 +26,86 @@ def convert_file(path: Path):
     return mel.astype(np.float32), quant.astype(np.int64)
 
 
-def process_wav(path: Path):
-    wav_id = path.split("/")[-1]
+def init_worker(hp_file, worker_paths: Paths):
+    """Loads hparams in each worker once, so nothing runs at import time"""
+    global paths
+    if not hp.is_configured():  # already configured if the worker was forked
+        hp.configure(hp_file)
+    paths = worker_paths
+
+
+def process_wav(path: str):
+    # paths cross the pool boundary as plain strings without the extension,
+    # so take the name rather than the stem
+    wav_id = Path(path).name
     m, x = convert_file(path)
     np.save(paths.mel/f'{wav_id}.npy', m, allow_pickle=False)
     np.save(paths.quant/f'{wav_id}.npy', x, allow_pickle=False)
     return wav_id, m.shape[-1]
 
 
-wav_files = get_files(path, hp.book_names, hp.metadata, extension)
-paths = Paths(hp.data_path, hp.voc_model_id, hp.tts_model_id)
+def main():
+    parser = argparse.ArgumentParser(description='Preprocessing for WaveRNN and Tacotron')
+    parser.add_argument('--path', '-p', help='directly point to location of CSV file')
+    parser.add_argument('--extension', '-e', metavar='EXT', default='.wav', help='file extension to search for in dataset folder')
+    parser.add_argument('--hp_file', metavar='FILE', default='hparams.py', help='The file to use for the hyperparameters')
+    args = parser.parse_args()
+
+    print(args.hp_file)
+    hp.configure(args.hp_file)  # Load hparams from file
+    if args.path is None:
+        args.path = hp.wav_path
+
+    extension = args.extension
+    path = args.path
+
+    wav_files = get_files(path, hp.book_names, hp.metadata, extension)
+    paths = Paths(hp.data_path, hp.voc_model_id, hp.tts_model_id)
+
+    print(wav_files[0])
+    print(f'\n{len(wav_files)} {extension[1:]} files found in "{path}"\n')
+
+    if len(wav_files) == 0:
+
+        print('Please point wav_path in hparams.py to your dataset,')
+        print('or use the --path option.\n')
 
-print(wav_files[0])
-print(f'\n{len(wav_files)} {extension[1:]} files found in "{path}"\n')
+    else:
 
-if len(wav_files) == 0:
+        if not hp.ignore_tts:
 
-    print('Please point wav_path in hparams.py to your dataset,')
-    print('or use the --path option.\n')
+            text_dict = blizzard(path, hp.book_names, hp.metadata)
 
-else:
+            with open(paths.data/'text_dict.pkl', 'wb') as f:
+                pickle.dump(text_dict, f)
 
-    if not hp.ignore_tts:
 
-        text_dict = blizzard(path, hp.book_names, hp.metadata)
 
-        with open(paths.data/'text_dict.pkl', 'wb') as f:
-            pickle.dump(text_dict, f)
+        simple_table([
+            ('Sample Rate', hp.sample_rate),
+            ('Bit Depth', hp.bits),
+            ('Mu Law', hp.mu_law),
+            ('Hop Length', hp.hop_length),
+            ('CPU Usage', f'{cpu_count()}')
+        ])
 
+        dataset = []
 
+        # batch several files per task to amortise the IPC round-trip per file
+        chunksize = max(1, len(wav_files) // (cpu_count() * 8))
 
-    simple_table([
-        ('Sample Rate', hp.sample_rate),
-        ('Bit Depth', hp.bits),
-        ('Mu Law', hp.mu_law),
-        ('Hop Length', hp.hop_length),
-        ('CPU Usage', f'{cpu_count()}')
-    ])
+        with ProcessPoolExecutor(max_workers=cpu_count(), initializer=init_worker, initargs=(args.hp_file, paths)) as executor:
+            for i, (item_id, length) in enumerate(executor.map(process_wav, wav_files, chunksize=chunksize), 1):
+                dataset += [(item_id, length)]
+                bar = progbar(i, len(wav_files))
+                message = f'{bar} {i}/{len(wav_files)} '
+                stream(message)
 
-    pool = Pool(processes=cpu_count())
-    dataset = []
+        with open(paths.data/'dataset.pkl', 'wb') as f:
+            pickle.dump(dataset, f)
 
-    for i, (item_id, length) in enumerate(pool.imap_unordered(process_wav, wav_files), 1):
-        dataset += [(item_id, length)]
-        bar = progbar(i, len(wav_files))
-        message = f'{bar} {i}/{len(wav_files)} '
-        stream(message)
+        print('\n\nCompleted. Ready to run "python train_tacotron.py" or "python train_wavernn.py". \n')
 
-    with open(paths.data/'dataset.pkl', 'wb') as f:
-        pickle.dump(dataset, f)
 
-    print('\n\nCompleted. Ready to run "python train_tacotron.py" or "python train_wavernn.py". \n')
+if __name__ == "__main__":
+    main()
@@ -15,6 +15,7 @@ import time
 import numpy as np
 import sys
 from utils.checkpoints import save_checkpoint, restore_checkpoint
+from utils.files import load_attention_guide
 
 
 def np_now(x: torch.Tensor): return x.detach().cpu().numpy()
@@ -145,7 +146,7 @@ def tts_train_loop(paths: Paths, model: Tacotron, optimizer, train_set, lr, trai
 
             att_guide_path = hp.attention_path
             for j,item_id in enumerate(ids):
-                att = np.load(f'{att_guide_path}/{item_id}.npy')
+                att = load_attention_guide(att_guide_path, item_id)
                 reduced = att[0::r]
 
 
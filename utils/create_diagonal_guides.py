@@ -1,45 +1,90 @@
 #Plot attention matrix for to be "nearly diagonal"
+import math
 import numpy as np
 from utils.text import text_to_sequence
 import os, argparse
 from utils import hparams as hp
 import pickle
+from multiprocessing import Pool, cpu_count
+
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+
+if njit is not None:
+    # Serial kernel: create_attention_guides already parallelises across items with a Pool.
+    # The on-disk cache (utils/__pycache__/*.nbi, *.nbc) is keyed on the importing module,
+    # clear it (or set NUMBA_CACHE_DIR) if the module is loaded under another name.
+    @njit(fastmath=True, cache=True)
+    def _guide(xdim, ydim, g):
+        # Fused single pass over W, no broadcast temporaries
+        W = np.empty((xdim, ydim), dtype=np.float32)
+        inv_g2 = 1.0 / (2 * g * g)
+        for i in range(xdim):
+            n_pos = i / xdim
+            for j in range(ydim):
+                d = j / ydim - n_pos
+                W[i, j] = 1.0 - math.exp(-d * d * inv_g2)
+        return W
 
 
 def get_attention_guide(xdim, ydim, g=0.2):
     '''Guided attention (page 3 in the paper.) '''
-    W = np.zeros((xdim, ydim), dtype=np.float32)
-    for n_pos in range(xdim):
-        for t_pos in range(ydim):
-            W[n_pos, t_pos] = 1 - np.exp(-(t_pos / float(ydim) - n_pos / float(xdim)) ** 2 / (2 * g * g))
-    return W
+    if njit is not None:
+        return _guide(xdim, ydim, g)
+    n_pos = np.arange(xdim, dtype=np.float32)[:, None] / xdim
+    t_pos = np.arange(ydim, dtype=np.float32)[None, :] / ydim
+    W = 1 - np.exp(-(t_pos - n_pos) ** 2 / (2 * g * g))
+    return W.astype(np.float32, copy=False)
 
 
-def create_attention_guides(fpath):
-    dataset_ids = []
-    mel_lengths = []
-    text_lengths = []
+def _make_guide(job):
+    shard_file, offset, text_length, mel_length = job
+    if text_length * mel_length == 0:  # nothing to write, and mmap rejects empty slots
+        return
+    # Each worker maps and fills only its own slot of the preallocated shard.
+    # float16 halves disk and dataloader traffic, see utils.files.load_attention_guide
+    slot = np.memmap(shard_file, dtype=np.float16, mode='r+', offset=offset * 2,
+                     shape=(text_length, mel_length))
+    slot[:] = get_attention_guide(text_length, mel_length, g=0.2)
+    slot.flush()
+
+
+def create_attention_guides(fpath, shard_size=1024):
 
     with open(f'{fpath}/dataset.pkl', 'rb') as f:
           dataset = pickle.load(f)
 
-    for (item_id, l) in dataset:
-        dataset_ids += [item_id]
-        mel_lengths += [l]
-
     with open(f'{fpath}/text_dict.pkl', 'rb') as f:
           text_dict = pickle.load(f)
 
-    for item_id in dataset_ids:
-      x = text_to_sequence(text_dict[item_id], ['blizz_cleaners'])
+    text_lengths = {item_id: len(text_to_sequence(text_dict[item_id], ['blizz_cleaners'])) for (item_id, _) in dataset}
+
+    guide_path = os.path.join(fpath, 'diagonal_attention_guides')
+    os.makedirs(guide_path, exist_ok=True)
+
+    # Every guide's shape is known up front, so lay out the shards and write the
+    # index before computing anything: item_id -> (shard, offset, xdim, ydim)
+    index = {}
+    shard_sizes = {}
+    jobs = []
+    for i, (item_id, mel_length) in enumerate(dataset):
+        shard = f'shard_{i // shard_size:05d}.bin'
+        offset = shard_sizes.get(shard, 0)
+        index[item_id] = (shard, offset, text_lengths[item_id], mel_length)
+        jobs.append((os.path.join(guide_path, shard), offset, text_lengths[item_id], mel_length))
+        shard_sizes[shard] = offset + text_lengths[item_id] * mel_length
 
-      text_lengths += [len(x)]
+    for shard, total in shard_sizes.items():
+        np.memmap(os.path.join(guide_path, shard), dtype=np.float16, mode='w+', shape=(total,)).flush()
 
-    for i,id in enumerate(dataset_ids):
+    with open(os.path.join(guide_path, 'guides_index.pkl'), 'wb') as f:
+        pickle.dump(index, f)
 
-      attfile = os.path.join(fpath, 'diagonal_attention_guides', id+'.npy')
-      att = get_attention_guide(text_lengths[i], mel_lengths[i], g=0.2)
-      np.save(attfile, att)
+    with Pool(cpu_count()) as pool:
+        pool.map(_make_guide, jobs)
 
 
 if __name__=="__main__":
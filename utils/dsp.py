@@ -10,13 +10,19 @@ def label_2_float(x, bits):
 
 
 def float_2_label(x, bits):
-    assert abs(x).max() <= 1.0
-    x = (x + 1.) * (2**bits - 1) / 2
-    return x.clip(0, 2**bits - 1)
+    assert max(x.max(), -x.min()) <= 1.0
+    x = x + 1.
+    x *= (2**bits - 1)
+    x /= 2
+    return np.clip(x, 0, 2**bits - 1, out=x)
 
 
-def load_wav(path):
-    return librosa.load(path, sr=hp.sample_rate)[0]
+def load_wav(path, return_peak=False):
+    y = librosa.load(path, sr=hp.sample_rate)[0]
+    if return_peak:
+        # max/min avoid allocating the abs(y) copy
+        return y, max(y.max(), -y.min())
+    return y
 
 
 def save_wav(x, path):
@@ -90,9 +96,20 @@ def de_emphasis(x):
 
 
 def encode_mu_law(x, mu):
+    # Same arithmetic as sign(x) * log(1 + mu|x|) / log(1 + mu), scaled to
+    # labels, but done in place where possible to avoid temporaries. The
+    # division is not in place so it promotes exactly as the original did.
     mu = mu - 1
-    fx = np.sign(x) * np.log(1 + mu * np.abs(x)) / np.log(1 + mu)
-    return np.floor((fx + 1) / 2 * mu + 0.5)
+    fx = np.abs(x) * mu
+    fx += 1
+    np.log(fx, out=fx)
+    np.copysign(fx, x, out=fx)
+    fx = fx / np.log(1 + mu)
+    fx += 1
+    fx /= 2
+    fx *= mu
+    fx += 0.5
+    return np.floor(fx, out=fx)
 
 
 def decode_mu_law(y, mu, from_labels=True):
@@ -1,4 +1,6 @@
 import os
+import pickle
+import numpy as np
 
 
 def get_files(path, books, metadata, extension='.csv'):
@@ -27,3 +29,50 @@ def get_files(path, books, metadata, extension='.csv'):
 
 
     return filenames
+
+
+def durations_to_attention_matrix(durations):
+    '''
+    Take array of durations, return (nframes, nphones) selection matrix to replace A
+    in attention mechanism. E.g.:
+    durations_to_attention_matrix(np.array([3,0,1,2])).T
+    [[1. 1. 1. 0. 0. 0.]
+     [0. 0. 0. 0. 0. 0.]
+     [0. 0. 0. 1. 0. 0.]
+     [0. 0. 0. 0. 1. 1.]]
+    '''
+    nphones = len(durations)
+    nframes = int(durations.sum())
+    cols = np.repeat(np.arange(nphones, dtype=np.int32), durations)
+    A = np.zeros((nframes, nphones), dtype=np.float32)
+    A[np.arange(nframes), cols] = 1.0
+    return A
+
+
+_guide_shards = {}
+
+
+def load_attention_guide(path, item_id):
+    """Loads an attention guide as a dense (nframes, nphones) float32 array.
+    Duration guides are stored as 1-D per-phone durations in .npy files, diagonal
+    guides as float16 shards with a guides_index.pkl (or as 2-D .npy files from
+    older runs)."""
+    if path not in _guide_shards:
+        index_file = os.path.join(path, 'guides_index.pkl')
+        index = None
+        if os.path.exists(index_file):
+            with open(index_file, 'rb') as f:
+                index = pickle.load(f)
+        _guide_shards[path] = (index, {})
+
+    index, shards = _guide_shards[path]
+    if index is not None and item_id in index:
+        shard, offset, xdim, ydim = index[item_id]
+        if shard not in shards:
+            shards[shard] = np.memmap(os.path.join(path, shard), dtype=np.float16, mode='r')
+        return shards[shard][offset:offset + xdim * ydim].reshape(xdim, ydim).astype(np.float32)
+
+    att = np.load(os.path.join(path, f'{item_id}.npy'))
+    if att.ndim == 1:
+        return durations_to_attention_matrix(att)
+    return att.astype(np.float32)